@@ -1,20 +1,36 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Headless backend so worker processes can render
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import os
-import glob
+import copy
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+
 
 class RopeStateAnalyzer:
-    def __init__(self, fps=30,n_particles=10,csv_directory="."):
+    def __init__(self, fps=30,n_particles=10,csv_directory=".",video_codec="libx264",make_video=False,
+                 video_seconds=30):
         """
         Initialize the rope state analyzer.
 
         Args:
             csv_directory (str): Directory containing CSV files ending with
                                'simulation.csv'
+            video_codec (str): ffmpeg video encoder, e.g. 'libx264' or a
+                               hardware encoder such as 'h264_nvenc'
+            make_video (bool): Whether the comprehensive analysis encodes
+                               the 3D rope video
+            video_seconds (float): Target length of the 3D rope video; longer
+                                   simulations are animated every n-th step
         """
         self.csv_directory = csv_directory
         self.fps = fps
@@ -22,11 +38,21 @@ class RopeStateAnalyzer:
         os.makedirs(self.save_dir, exist_ok=True)
         self.simulation_files = self._find_simulation_files()
         self.n_particles = n_particles
+        self.video_codec = video_codec
+        self.make_video = make_video
+        self.video_seconds = video_seconds
+        # Plain dict rather than functools.lru_cache: a cache on the method
+        # is shared by all instances and keeps them alive, and a per-instance
+        # wrapper cannot be pickled; a dict can simply be emptied in the
+        # analyzer copy that analyze_all_simulations sends to its workers
+        self._pos_cache = {}
 
     def _find_simulation_files(self):
         """Find all CSV files ending with 'simulation.csv'"""
-        pattern = os.path.join(self.csv_directory, "*simulation.csv")
-        files = glob.glob(pattern)
+        with os.scandir(self.csv_directory) as entries:
+            files = [entry.path for entry in entries
+                     if entry.name.endswith("simulation.csv")
+                     and not entry.name.startswith(".") and entry.is_file()]
         print(f"Found {len(files)} simulation files:")
         for file in files:
             print(f"  - {os.path.basename(file)}")
@@ -36,6 +62,10 @@ class RopeStateAnalyzer:
         """
         Load simulation data from CSV file.
 
+        Only the particle columns are kept, as float32. When PyArrow is installed they
+        are cached next to the CSV as '<filename>.parquet' and read from
+        there while the cache is newer than the CSV.
+
         Args:
             filename (str): Name of the CSV file
 
@@ -43,17 +73,51 @@ class RopeStateAnalyzer:
             tuple: (data, num_particles, num_steps)
         """
         filepath = os.path.join(self.csv_directory, filename)
-        if not os.path.exists(filepath):
-            raise FileNotFoundError(f"File not found: {filepath}")
 
-        # Load CSV data
-        data = pd.read_csv(filepath)
+        # Reuse the Parquet sidecar if it is newer than the CSV
+        cache_path = filepath + '.parquet'
+        data = None
+        if (pacsv is not None and os.path.exists(cache_path)
+                and os.path.getmtime(cache_path) >= os.path.getmtime(filepath)):
+            try:
+                data = pd.read_parquet(cache_path, engine='pyarrow')
+            except (OSError, pa.ArrowException) as e:
+                # Damaged sidecar: re-parse the CSV, which rewrites it
+                print(f"Ignoring unreadable Parquet cache {cache_path}: {e}")
+
+        if data is None:
+            # Parse only the particle columns, as float32
+            header = pd.read_csv(filepath, nrows=0).columns
+            particle_cols = [col for col in header if col.startswith('Particle')]
+
+            # Load CSV data (PyArrow's multithreaded reader when available)
+            if pacsv is not None:
+                convert_options = pacsv.ConvertOptions(
+                    include_columns=particle_cols,
+                    column_types={col: pa.float32() for col in particle_cols})
+                table = pacsv.read_csv(filepath,
+                                       read_options=pacsv.ReadOptions(use_threads=True),
+                                       convert_options=convert_options)
+                data = table.to_pandas()
+            else:
+                data = pd.read_csv(filepath, usecols=particle_cols, dtype=np.float32, engine='c')
+
+            # Cache the particle columns for later runs. Write to a temporary
+            # file first so an interrupted write never leaves a partial cache.
+            if pacsv is not None:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                try:
+                    data.to_parquet(tmp_path, engine='pyarrow', index=False)
+                    os.replace(tmp_path, cache_path)
+                except (OSError, pa.ArrowException) as e:
+                    print(f"Could not write Parquet cache {cache_path}: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
 
         # Extract number of particles and steps
         num_steps = len(data)
-        particle_columns = [col for col in data.columns
-                          if col.startswith('Particle')]
-        num_particles = len(particle_columns) // 3  # X, Y, Z for each particle
+        # Only particle columns are loaded: X, Y, Z for each particle
+        num_particles = data.shape[1] // 3
 
         print(f"Loaded {filename}:")
         print(f"  - Steps: {num_steps}")
@@ -82,15 +146,36 @@ class RopeStateAnalyzer:
 
         return x_positions, y_positions, z_positions
 
-    def plot_trajectories(self, filename, save_plot=True):
+    def _get_positions(self, filename):
+        """
+        Get the particle position tensor for a CSV file, loading it only once.
+
+        Args:
+            filename (str): Name of the CSV file
+
+        Returns:
+            tuple: (positions, num_steps) where positions has shape
+                   (num_steps, num_particles, 3)
+        """
+        if filename not in self._pos_cache:
+            data, num_particles, num_steps = self.load_simulation_data(filename)
+            positions = data.to_numpy(dtype=np.float32, copy=False)
+            positions = positions.reshape(num_steps, num_particles, 3)
+            self._pos_cache[filename] = (positions, num_steps)
+        return self._pos_cache[filename]
+
+    def plot_trajectories(self, filename, save_plot=True, sim_data=None):
         """
         Plot X, Y, Z trajectories for initial, middle, and end particles.
 
         Args:
             filename (str): Name of the CSV file
             save_plot (bool): Whether to save the plot
+            sim_data (tuple): Pre-loaded (positions, num_steps) from
+                              _get_positions; loaded from file if None
         """
-        data, num_particles, num_steps = self.load_simulation_data(filename)
+        positions, num_steps = sim_data or self._get_positions(filename)
+        steps = np.arange(num_steps, dtype=np.int32)
 
         # Define particles to plot
         initial_particle = 0
@@ -106,21 +191,23 @@ class RopeStateAnalyzer:
         fig.suptitle(f'Particle Trajectories - {filename}', fontsize=16)
 
         for i, (particle_idx, name, color) in enumerate(zip(particles_to_plot, particle_names, colors)):
-            x_pos, y_pos, z_pos = self.extract_particle_positions(data, particle_idx)
+            x_pos = positions[:, particle_idx, 0]
+            y_pos = positions[:, particle_idx, 1]
+            z_pos = positions[:, particle_idx, 2]
 
             # Plot X trajectory
-            axes[0].plot(range(num_steps), x_pos, color=color, label=f'{name} Particle', linewidth=2)
+            axes[0].plot(steps, x_pos, color=color, label=f'{name} Particle', linewidth=2)
             axes[0].set_ylabel('X Position')
             axes[0].grid(True, alpha=0.3)
             axes[0].legend()
 
             # Plot Y trajectory
-            axes[1].plot(range(num_steps), y_pos, color=color, linewidth=2)
+            axes[1].plot(steps, y_pos, color=color, linewidth=2)
             axes[1].set_ylabel('Y Position')
             axes[1].grid(True, alpha=0.3)
 
             # Plot Z trajectory
-            axes[2].plot(range(num_steps), z_pos, color=color, linewidth=2)
+            axes[2].plot(steps, z_pos, color=color, linewidth=2)
             axes[2].set_ylabel('Z Position')
             axes[2].set_xlabel('Simulation Step')
             axes[2].grid(True, alpha=0.3)
@@ -131,33 +218,36 @@ class RopeStateAnalyzer:
             plot_filename = os.path.join(self.save_dir, filename.replace('.csv', '_trajectories.png'))
             plt.savefig(plot_filename, dpi=300, bbox_inches='tight')
             print(f"Trajectory plot saved as: {plot_filename}")
-            plt.clf()
+            plt.close(fig)
 
-    def create_3d_rope_visualization(self, filename, save_video=True):
+    def create_3d_rope_visualization(self, filename, save_video=True, sim_data=None):
         """
         Create 3D visualization of the rope and generate a video.
 
         Args:
             filename (str): Name of the CSV file
             save_video (bool): Whether to save the video
+            sim_data (tuple): Pre-loaded (positions, num_steps) from
+                              _get_positions; loaded from file if None
+
+        Returns:
+            FuncAnimation: The animation. Its figure is closed once the video
+                           is saved; otherwise the caller must close it.
         """
-        data, num_particles, num_steps = self.load_simulation_data(filename)
+        positions, num_steps = sim_data or self._get_positions(filename)
+        positions = positions[:, :self.n_particles]
 
         # Set up the 3D figure
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(111, projection='3d')
 
         # Get position ranges for consistent axis limits
-        all_x, all_y, all_z = [], [], []
-        for i in range(self.n_particles):
-            x_pos, y_pos, z_pos = self.extract_particle_positions(data, i)
-            all_x.extend(x_pos)
-            all_y.extend(y_pos)
-            all_z.extend(z_pos)
+        mins = positions.reshape(-1, 3).min(axis=0)
+        maxs = positions.reshape(-1, 3).max(axis=0)
 
-        x_min, x_max = min(all_x), max(all_x)
-        y_min, y_max = min(all_y), max(all_y)
-        z_min, z_max = min(all_z), max(all_z)
+        x_min, x_max = mins[0], maxs[0]
+        y_min, y_max = mins[1], maxs[1]
+        z_min, z_max = mins[2], maxs[2]
 
         # Add some padding to the axis limits
         padding = 0.1
@@ -180,17 +270,15 @@ class RopeStateAnalyzer:
         # Initialize line plot for rope connections
         line, = ax.plot([], [], [], 'r-', linewidth=2, alpha=0.6)
 
+        # Step counter drawn as a blittable artist instead of re-laying out the title
+        step_text = ax.text2D(0.02, 0.95, '', transform=ax.transAxes)
+
+        # Pre-slice every frame as contiguous (3, n_particles) X/Y/Z rows
+        frames = np.ascontiguousarray(positions.transpose(0, 2, 1))
+
         def animate(frame):
             # Update particle positions
-            x_positions = []
-            y_positions = []
-            z_positions = []
-
-            for i in range(self.n_particles):
-                x_pos, y_pos, z_pos = self.extract_particle_positions(data, i)
-                x_positions.append(x_pos[frame])
-                y_positions.append(y_pos[frame])
-                z_positions.append(z_pos[frame])
+            x_positions, y_positions, z_positions = frames[frame]
 
             # Update scatter plot
             scatter._offsets3d = (x_positions, y_positions, z_positions)
@@ -199,23 +287,34 @@ class RopeStateAnalyzer:
             line.set_data(x_positions, y_positions)
             line.set_3d_properties(z_positions)
 
-            # Update title with current step
-            ax.set_title(f'3D Rope Visualization - {filename} (Step {frame})')
+            # Update step counter
+            step_text.set_text(f'Step {frame}')
+
+            return scatter, line, step_text
 
-            return scatter, line
+        # Skip steps so the video lasts at most about video_seconds
+        stride = max(1, int(np.ceil(num_steps / (self.fps * self.video_seconds))))
 
         # Create animation
         anim = animation.FuncAnimation(
-            fig, animate, frames=num_steps,
-            interval=1000//self.fps, blit=False, repeat=True
+            fig, animate, frames=range(0, num_steps, stride),
+            interval=1000//self.fps, blit=True, repeat=True
         )
 
         if save_video:
             video_filename = os.path.join(self.save_dir, filename.replace('.csv', '_3d_visualization.mp4'))
             print(f"Creating video: {video_filename}")
-            anim.save(video_filename, writer='ffmpeg', fps=self.fps, dpi=100)
-            print(f"Video saved as: {video_filename}")
-            plt.clf()
+            extra_args = ['-pix_fmt', 'yuv420p']
+            if self.video_codec == 'libx264':
+                extra_args += ['-preset', 'ultrafast', '-crf', '23']
+            # Frames go through temporary PNG files to keep peak memory low
+            writer = animation.FFMpegFileWriter(fps=self.fps, codec=self.video_codec,
+                                                extra_args=extra_args)
+            try:
+                anim.save(video_filename, writer=writer, dpi=72)
+                print(f"Video saved as: {video_filename}")
+            finally:
+                plt.close(fig)
 
         return anim
 
@@ -237,9 +336,14 @@ class RopeStateAnalyzer:
         # Define colors for different simulations
         simulation_colors = ['red', 'blue', 'green', 'orange', 'purple', 'brown', 'pink', 'gray']
 
+        # Legend entries for the X subplot
+        legend_handles, legend_labels = [], []
+
         for file_idx, filename in enumerate(self.simulation_files):
             try:
-                data, num_particles, num_steps = self.load_simulation_data(os.path.basename(filename))
+                positions, num_steps = self._get_positions(os.path.basename(filename))
+                num_particles = positions.shape[1]
+                steps = np.arange(num_steps, dtype=np.int32)
 
                 # Define particles to plot
                 initial_particle = 0
@@ -252,32 +356,32 @@ class RopeStateAnalyzer:
                 color = simulation_colors[file_idx % len(simulation_colors)]
                 sim_name = os.path.basename(filename).replace('_simulation.csv', '')
 
-                for i, (particle_idx, name) in enumerate(zip(particles_to_plot, particle_names)):
-                    x_pos, y_pos, z_pos = self.extract_particle_positions(data, particle_idx)
+                # (num_steps, 3) columns per axis: one plot call draws all three particles
+                selected = positions[:, particles_to_plot]
 
-                    # Plot X trajectory
-                    axes[0].plot(range(num_steps), x_pos, color=color,
-                                label=f'{sim_name} - {name}', linewidth=2, alpha=0.8)
-                    axes[0].set_ylabel('X Position')
-                    axes[0].grid(True, alpha=0.3)
+                # Plot X trajectories
+                lines = axes[0].plot(steps, selected[:, :, 0], color=color,
+                                     linewidth=2, alpha=0.8)
+                legend_handles.extend(lines)
+                legend_labels.extend(f'{sim_name} - {name}' for name in particle_names)
 
-                    # Plot Y trajectory
-                    axes[1].plot(range(num_steps), y_pos, color=color, linewidth=2, alpha=0.8)
-                    axes[1].set_ylabel('Y Position')
-                    axes[1].grid(True, alpha=0.3)
+                # Plot Y trajectories
+                axes[1].plot(steps, selected[:, :, 1], color=color, linewidth=2, alpha=0.8)
 
-                    # Plot Z trajectory
-                    axes[2].plot(range(num_steps), z_pos, color=color, linewidth=2, alpha=0.8)
-                    axes[2].set_ylabel('Z Position')
-                    axes[2].set_xlabel('Simulation Step')
-                    axes[2].grid(True, alpha=0.3)
+                # Plot Z trajectories
+                axes[2].plot(steps, selected[:, :, 2], color=color, linewidth=2, alpha=0.8)
 
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
                 continue
 
+        for ax, axis_name in zip(axes, 'XYZ'):
+            ax.set_ylabel(f'{axis_name} Position')
+            ax.grid(True, alpha=0.3)
+        axes[2].set_xlabel('Simulation Step')
+
         # Add legend to first subplot
-        axes[0].legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+        axes[0].legend(legend_handles, legend_labels, bbox_to_anchor=(1.05, 1), loc='upper left')
 
         plt.tight_layout()
 
@@ -285,56 +389,53 @@ class RopeStateAnalyzer:
             plot_filename = os.path.join(self.save_dir, 'combined_trajectories.png')
             plt.savefig(plot_filename, dpi=300, bbox_inches='tight')
             print(f"Combined trajectory plot saved as: {plot_filename}")
-            plt.clf()
+            plt.close(fig)
 
-    def create_comprehensive_analysis(self, filename):
+    def create_comprehensive_analysis(self, filename, sim_data=None):
         """
         Create comprehensive analysis including trajectories and 3D visualization.
 
         Args:
             filename (str): Name of the CSV file
+            sim_data (tuple): Pre-loaded (positions, num_steps) from
+                              _get_positions; loaded from file if None
         """
         print(f"\n{'='*60}")
         print(f"ANALYZING: {filename}")
         print(f"{'='*60}")
 
+        # Load the simulation once and share it with every analysis step
+        sim_data = sim_data or self._get_positions(filename)
+
         # Plot trajectories
-        self.plot_trajectories(filename)
+        self.plot_trajectories(filename, sim_data=sim_data)
 
-        # Create 3D visualization
-        self.create_3d_rope_visualization(filename)
+        # Create 3D visualization (only needed when the video is written)
+        if self.make_video:
+            self.create_3d_rope_visualization(filename, sim_data=sim_data)
 
         # Additional analysis
-        self._analyze_rope_properties(filename)
+        self._analyze_rope_properties(filename, sim_data=sim_data)
 
-    def _analyze_rope_properties(self, filename):
+    def _analyze_rope_properties(self, filename, sim_data=None):
         """
         Analyze rope properties like length changes, energy, etc.
 
         Args:
             filename (str): Name of the CSV file
+            sim_data (tuple): Pre-loaded (positions, num_steps) from
+                              _get_positions; loaded from file if None
         """
-        data, num_particles, num_steps = self.load_simulation_data(filename)
+        positions, num_steps = sim_data or self._get_positions(filename)
+        steps = np.arange(num_steps, dtype=np.int32)
 
         # Calculate rope length over time
-        lengths = []
-        for step in range(num_steps):
-            total_length = 0
-            for i in range(self.n_particles - 1):
-                x1, y1, z1 = self.extract_particle_positions(data, i)
-                x2, y2, z2 = self.extract_particle_positions(data, i + 1)
-
-                segment_length = np.sqrt(
-                    (x2[step] - x1[step])**2 +
-                    (y2[step] - y1[step])**2 +
-                    (z2[step] - z1[step])**2
-                )
-                total_length += segment_length
-            lengths.append(total_length)
+        segments = np.diff(positions[:, :self.n_particles], axis=1)
+        lengths = np.sqrt(np.einsum('spk,spk->sp', segments, segments)).sum(axis=1)
 
         # Plot rope length over time
-        plt.figure(figsize=(10, 6))
-        plt.plot(range(num_steps), lengths, 'b-', linewidth=2)
+        fig = plt.figure(figsize=(10, 6))
+        plt.plot(steps, lengths, 'b-', linewidth=2)
         plt.xlabel('Simulation Step')
         plt.ylabel('Rope Length')
         plt.title(f'Rope Length Over Time - {filename}')
@@ -350,7 +451,7 @@ class RopeStateAnalyzer:
         plot_filename = os.path.join(self.save_dir, filename.replace('.csv', '_length_analysis.png'))
         plt.savefig(plot_filename, dpi=300, bbox_inches='tight')
         print(f"Length analysis plot saved as: {plot_filename}")
-        plt.clf()
+        plt.close(fig)
 
         print(f"Rope Length Statistics:")
         print(f"  - Mean length: {mean_length:.3f}")
@@ -372,19 +473,59 @@ class RopeStateAnalyzer:
         print("\nCreating combined trajectory plot...")
         self.plot_all_trajectories_combined()
 
-        # Then analyze each simulation individually
-        for filename in self.simulation_files:
-            try:
-                self.create_comprehensive_analysis(os.path.basename(filename))
-            except Exception as e:
-                print(f"Error analyzing {filename}: {e}")
-                continue
+        # Then analyze each simulation individually, one process per file.
+        # Workers get a cache-free copy of the analyzer once at start-up and
+        # each task carries only its own file's positions (None if the
+        # combined plot could not load it, in which case the worker loads it).
+        basenames = [os.path.basename(filename) for filename in self.simulation_files]
+        if basenames:
+            sim_data = [self._pos_cache.get(filename) for filename in basenames]
+            worker_analyzer = copy.copy(self)
+            worker_analyzer._pos_cache = {}
+            # No more workers than files; Windows rejects more than 61
+            max_workers = min(len(basenames), os.cpu_count() or 1, 61)
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                     initargs=(worker_analyzer,)) as executor:
+                list(executor.map(_analyze_file, basenames, sim_data))
+
+        plt.close('all')
+
+    def _analyze_one(self, filename, sim_data=None):
+        """
+        Run the comprehensive analysis for one file, reporting any error.
+
+        Args:
+            filename (str): Name of the CSV file
+            sim_data (tuple): Pre-loaded (positions, num_steps) from
+                              _get_positions; loaded from file if None
+        """
+        try:
+            self.create_comprehensive_analysis(filename, sim_data=sim_data)
+        except Exception as e:
+            print(f"Error analyzing {filename}: {e}")
+
+
+# Analyzer used by each worker process of analyze_all_simulations
+_worker_analyzer = None
+
+
+def _init_worker(analyzer):
+    """Store the analyzer for this worker process."""
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+
+def _analyze_file(filename, sim_data):
+    """Analyze one simulation file in a worker process."""
+    _worker_analyzer._analyze_one(filename, sim_data)
+
 
-def main(fps=30,n_particles=10,csv_directory="."):
+def main(fps=30,n_particles=10,csv_directory=".",make_video=False):
     """Main function to run the analysis."""
 
     # Initialize analyzer
-    analyzer = RopeStateAnalyzer(fps=fps, n_particles=n_particles, csv_directory=csv_directory)
+    analyzer = RopeStateAnalyzer(fps=fps, n_particles=n_particles, csv_directory=csv_directory,
+                                 make_video=make_video)
 
     # Check if simulation files exist
     if not analyzer.simulation_files:
@@ -399,7 +540,8 @@ def main(fps=30,n_particles=10,csv_directory="."):
     print("ANALYSIS COMPLETE!")
     print("Generated files:")
     print("  - *_trajectories.png: Particle trajectory plots")
-    print("  - *_3d_visualization.mp4: 3D rope animation videos")
+    if make_video:
+        print("  - *_3d_visualization.mp4: 3D rope animation videos")
     print("  - *_length_analysis.png: Rope length analysis")
     print(f"{'='*80}")
 
@@ -407,4 +549,5 @@ if __name__ == "__main__":
     _fps = 30
     n_particles = 10
     csv_directory =r"C:\Users\kawaw\cpp\rope-modeling\pbd\PBD\PBD\csv"
-    main(fps=_fps,n_particles=n_particles,csv_directory=csv_directory)
+    make_video = False  # Set True to also encode the 3D rope videos
+    main(fps=_fps,n_particles=n_particles,csv_directory=csv_directory,make_video=make_video)